@@ -1,34 +1,41 @@
+import hashlib
 import importlib
+import json
+import os
 
+import numpy as np
 import pandas as pd
 import yaml
 
 
-def generate_kanon_config(sample: pd.DataFrame, k: int, cn_config: dict, topics: tuple):
+def generate_kanon_config(sample: pd.DataFrame, k: int, cn_config: dict, topics: tuple, cache_dir: str = None,
+                          incremental: bool = False):
     """
     Generate a config that contains a set of rules that guarantee k-anonymity on a given dataset. Use these rules
     to apply them to a stream of data.
 
+    If a ``cache_dir`` is given, the result of the k-anonymity search is stored there, keyed by a fingerprint of the
+    sample, ``k`` and ``cn_config``, and is reused for identical inputs. With ``incremental``, the generalization
+    found for the previous sample (with the same ``k`` and ``cn_config``) is reused as long as it still makes the new
+    sample k-anonymous, which typically holds when only a few rows were added. Otherwise, the full search is run.
+
     :param sample: a pandas dataframe with the sample data
     :param k: the level of k
     :param cn_config: the config for cn_protect
                     (check the `docs <https://docs.cryptonumerics.com/cn-protect-ds/?page=docs.cryptonumerics.com/cn-protect-ds-html/protect.html>`_),
                     the library that applies k-ananymity. Sorry for this not being
                     open source. We are happy if you find a better python implementation of k-anonymity.
+    :param topics: the names of the in- and the output topic
+    :param cache_dir: directory to cache results of the k-anonymity search in. No caching if None. Only the
+                      ``MAX_CACHE_ENTRIES`` most recently used results are kept.
+    :param incremental: whether to try the previous generalization first. Requires ``cache_dir``.
     :return: a config that can be fed to the `spi <https://github.com/peng-data-minimization/kafka-spi>`_
     """
-    from cn.protect import Protect
-    from cn.protect.privacy import KAnonymity
     from cn.protect.hierarchy import DataHierarchy, OrderHierarchy
     import uuid
     import textwrap
 
-    protector = Protect(sample, KAnonymity(k))
-
-    for prop_name, config in cn_config.items():
-        protector.itypes[prop_name], protector.hierarchies[prop_name] = config
-
-    private = protector.protect()
+    generalization = _protect_cached(sample, k, cn_config, cache_dir, incremental)
 
     tasks = {}
 
@@ -41,19 +48,17 @@ def generate_kanon_config(sample: pd.DataFrame, k: int, cn_config: dict, topics:
         tasks[f"{signature}-{uuid.uuid4()}"] = kwargs
 
     for prop_name, (identifying, hierarchy) in cn_config.items():
-        if private[prop_name][0] == "*":
+        if generalization[prop_name] == "*":
             add_subtask("drop_keys", keys=[prop_name])
         elif hierarchy is None:
             pass  # no anonymization applied - do nothing
         elif isinstance(hierarchy, OrderHierarchy):
-            lower, upper = [float(bound) for bound in private[prop_name][0][1:-1].split(",")]
+            lower, upper = [float(bound) for bound in generalization[prop_name][1:-1].split(",")]
             add_subtask("reduce_to_nearest_value", keys=[prop_name], step_width=upper - lower)
         elif isinstance(hierarchy, DataHierarchy):
             actual_replacements = {}
             possible_replacements = hierarchy.df
-            for value in private[prop_name]:
-                # todo extract replaced from dataframe
-                pass
+            # todo extract replaced values from dataframe
             add_subtask("replace_with", replacements=actual_replacements)
         else:
             print("Warning: Unsupported hierarchy type " + str(type(hierarchy)))
@@ -87,19 +92,173 @@ def generate_kanon_config(sample: pd.DataFrame, k: int, cn_config: dict, topics:
     return worker_config
 
 
+MAX_CACHE_ENTRIES = 64  #: Number of k-anonymity search results kept in the cache directory.
+
+
+def _protect(sample: pd.DataFrame, k: int, cn_config: dict) -> dict:
+    """
+    Run the k-anonymity search.
+
+    :return: the generalization of each property of the cn_config, i.e. its value in the first protected row
+    """
+    from cn.protect import Protect
+    from cn.protect.privacy import KAnonymity
+
+    protector = Protect(sample, KAnonymity(k))
+
+    for prop_name, config in cn_config.items():
+        protector.itypes[prop_name], protector.hierarchies[prop_name] = config
+
+    private = protector.protect()
+    return {prop_name: _to_json_value(private[prop_name].iloc[0]) for prop_name in cn_config}
+
+
+def _protect_cached(sample: pd.DataFrame, k: int, cn_config: dict, cache_dir: str, incremental: bool) -> dict:
+    cn_config_fingerprint = _fingerprint_cn_config(cn_config) if cache_dir is not None else None
+    if cn_config_fingerprint is None:
+        if cache_dir is not None:
+            print("Warning: Not caching, the cn_config contains values that cannot be fingerprinted.")
+        return _protect(sample, k, cn_config)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    config_fingerprint = _fingerprint(k, cn_config_fingerprint, sorted(sample.columns))
+    sample_path = os.path.join(cache_dir, f"{_fingerprint(config_fingerprint, _fingerprint_sample(sample))}.json")
+    latest_path = os.path.join(cache_dir, f"latest-{config_fingerprint}.json")
+
+    generalization = _read_cache(sample_path)
+    if generalization is None and incremental:
+        previous = _read_cache(latest_path)
+        if previous is not None and _is_k_anonymous(sample, k, cn_config, previous):
+            print("Reusing the generalization of the previous sample.")
+            generalization = previous
+    if generalization is None:
+        generalization = _protect(sample, k, cn_config)
+
+    _write_cache(sample_path, generalization)
+    _write_cache(latest_path, generalization)
+    _evict_cache(cache_dir, MAX_CACHE_ENTRIES)
+    return generalization
+
+
+def _is_k_anonymous(sample: pd.DataFrame, k: int, cn_config: dict, generalization: dict) -> bool:
+    """
+    Check whether generalizing the sample like described by ``generalization`` yields groups of at least k rows. Only
+    interval hierarchies can be checked, anything else counts as not k-anonymous.
+    """
+    from cn.protect.hierarchy import OrderHierarchy
+
+    quasi_identifiers = {}
+    for prop_name, (identifying, hierarchy) in cn_config.items():
+        if identifying != "quasi":
+            continue
+        if generalization[prop_name] == "*":
+            continue  # suppressed entirely, does not split groups
+        elif hierarchy is None:
+            quasi_identifiers[prop_name] = sample[prop_name]
+        elif isinstance(hierarchy, OrderHierarchy):
+            lower, upper = [float(bound) for bound in generalization[prop_name][1:-1].split(",")]
+            quasi_identifiers[prop_name] = np.floor((sample[prop_name].to_numpy(dtype=float) - lower) / (upper - lower))
+        else:
+            return False
+
+    if not quasi_identifiers:
+        return len(sample) >= k
+    group_sizes = pd.DataFrame(quasi_identifiers).groupby(list(quasi_identifiers), dropna=False).size()
+    return bool(group_sizes.min() >= k)
+
+
+def _fingerprint(*parts) -> str:
+    return hashlib.sha256(repr(parts).encode("utf8")).hexdigest()
+
+
+def _fingerprint_sample(sample: pd.DataFrame) -> str:
+    row_hashes = pd.util.hash_pandas_object(sample, index=False).to_numpy()
+    return _fingerprint(list(sample.columns), hashlib.sha256(row_hashes.tobytes()).hexdigest())
+
+
+def _fingerprint_cn_config(cn_config: dict):
+    """
+    :return: a fingerprint of the cn_config that is stable across processes, or None if it contains values that
+             cannot be fingerprinted
+    """
+    try:
+        return _fingerprint(sorted((prop_name, identifying, _describe(hierarchy))
+                                   for prop_name, (identifying, hierarchy) in cn_config.items()))
+    except (TypeError, RecursionError):
+        return None
+
+
+def _describe(value):
+    """
+    Describe a value by its contents, as opposed to its repr, which might contain memory addresses or be truncated.
+
+    :raises TypeError: if the value cannot be described
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return type(value).__name__, _fingerprint_sample(pd.DataFrame(value))
+    if isinstance(value, np.ndarray):
+        return "ndarray", str(value.dtype), value.shape, hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__, [_describe(item) for item in value]
+    if isinstance(value, dict):
+        return "dict", sorted((repr(key), _describe(item)) for key, item in value.items())
+    if hasattr(value, "__dict__"):
+        return f"{type(value).__module__}.{type(value).__qualname__}", _describe(vars(value))
+    raise TypeError(f"Cannot fingerprint {type(value)}.")
+
+
+def _to_json_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _read_cache(path: str):
+    try:
+        with open(path) as cache_file:
+            generalization = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    os.utime(path)  # mark as recently used
+    return generalization
+
+
+def _write_cache(path: str, generalization: dict):
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as cache_file:
+        json.dump(generalization, cache_file, default=str)
+    os.replace(temporary_path, path)
+
+
+def _evict_cache(cache_dir: str, max_entries: int):
+    entries = sorted((entry.stat().st_mtime_ns, entry.path) for entry in os.scandir(cache_dir)
+                     if entry.name.endswith(".json"))
+    for _, path in entries[:max(0, len(entries) - max_entries)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Config generation util")
 
     parser.add_argument("--sample-data", required=True, help="the path to the sample data csv file.")
-    parser.add_argument("-k", required=True, help="k for k-anonymity.")
+    parser.add_argument("-k", required=True, type=int, help="k for k-anonymity.")
     parser.add_argument("--cn-config", required=True, help="name of the py file with initial configuration for "
                                                            "CN-protect library.")
     parser.add_argument("--topics", nargs=2, required=True, help="the names of the in- and the output topic.")
+    parser.add_argument("--cache-dir", help="directory to cache the results of the k-anonymity search in.")
+    parser.add_argument("--incremental", action="store_true", help="reuse the previous generalization if it "
+                                                                   "still holds for the sample.")
 
     args = parser.parse_args()
 
     cn_config = importlib.import_module("kanon_cn_config").cn_config
 
-    generate_kanon_config(pd.read_csv(args.sample_data), args.k, cn_config, tuple(args.topics))
+    generate_kanon_config(pd.read_csv(args.sample_data), args.k, cn_config, tuple(args.topics), args.cache_dir,
+                          args.incremental)
@@ -1,16 +1,25 @@
+import datetime
 import hashlib
+import numbers
+import re
 import statistics
 from collections.abc import Iterable
 from functools import partial
 from typing import Callable
 
-from numpy.random import default_rng
+import numpy as np
+import pandas as pd
+from numpy.random import default_rng, SeedSequence
 
 from .cvdi import anonymize_journey
 from .utils import check_input_type
+from .vault import PseudonymVault, open_vault
 
 anonymize_journey.__doc__
 
+_ISO_PRECISIONS = ["D", "h", "m", "s", "ms", "us", "ns"]  #: numpy units of ISO 8601 strings, coarsest first.
+_UTC_OFFSET_PATTERN = re.compile(r"(Z|[+-]\d{2}(:?\d{2})?)$")  #: Time zone designator at the end of an ISO 8601 string.
+
 
 @check_input_type
 def drop_keys(data: [dict], keys):
@@ -24,6 +33,29 @@ def drop_keys(data: [dict], keys):
     return _replace_with_function(data, keys, _reset_value)
 
 
+@check_input_type
+def project_keys(data: [dict], keep=None, drop=None):
+    """
+    Builds new dicts that only contain the given keys (``keep``) or that lack the given keys entirely (``drop``).
+    Unlike :func:`drop_keys`, this does remove the keys, which shrinks the records.
+
+    Keys use the same notation as the other functions, e.g. ``"A.B"`` for nested dicts and ``"A[].B"`` for dicts in
+    a list. Values that are kept as a whole are not copied.
+
+    :param data: input data as list of dicts
+    :param keep: list of keys to keep, everything else is removed
+    :param drop: list of keys to remove. Only used if ``keep`` is not given.
+    :return: list of new, slimmer dicts
+    """
+    if keep is not None:
+        tree = _build_key_tree(keep)
+        return [_keep_tree(item, tree) for item in data]
+    if drop is not None:
+        tree = _build_key_tree(drop)
+        return [_drop_tree(item, tree) for item in data]
+    return data
+
+
 @check_input_type
 def replace_with(data: [dict], replacements: dict):
     """
@@ -55,6 +87,30 @@ def hash_keys(data: [dict], keys, hash_algorithm=hashlib.sha256, salt=None, dige
                                   digest_to_bytes=digest_to_bytes, salt=salt)
 
 
+@check_input_type
+def tokenize_keys(data: [dict], keys, vault):
+    """
+    Replaces data for specific keys with random tokens. Unlike :func:`hash_keys`, tokens carry no information about
+    the original value; the same value consistently gets the same token because the mapping is persisted in a
+    :class:`~data_minimization_tools.vault.PseudonymVault`.
+
+    :param data: input data as list of dicts
+    :param keys: list of keys whose values should be tokenized
+    :param vault: a :class:`~data_minimization_tools.vault.PseudonymVault` or the path to its file
+    :return: cleaned list of dicts
+    """
+    if not isinstance(vault, PseudonymVault):
+        vault = open_vault(vault)
+    if isinstance(keys, str):
+        keys = [keys]
+    references = [(container, leaf_key) for key in keys for container, leaf_key in _collect_references(data, key)
+                  if container[leaf_key] is not None]
+    tokens = vault.tokenize_many(container[leaf_key] for container, leaf_key in references)
+    for container, leaf_key in references:
+        container[leaf_key] = tokens[str(container[leaf_key])]
+    return data
+
+
 @check_input_type
 def replace_with_distribution(data: [dict], keys, numpy_distribution_function_str='standard_normal', *distribution_args,
                               **distribution_kwargs):
@@ -76,6 +132,48 @@ def replace_with_distribution(data: [dict], keys, numpy_distribution_function_st
     return _replace_with_function(data, keys, func, pass_self_to_func=False, *distribution_args, **distribution_kwargs)
 
 
+@check_input_type
+def add_noise(data: [dict], keys, scale=1.0, distribution="laplace", seed=None):
+    """
+    Adds random noise to the (numeric) data for specific keys. Unlike :func:`replace_with_distribution`, the original
+    value is kept as the noise's center. The noise for all values of one key is drawn at once.
+
+    Calling this twice with the same seed adds the same noise twice. To process chunks of data, give each chunk its own
+    child of one seed, e.g. ``SeedSequence(seed).spawn(number_of_chunks)``, which keeps the result reproducible and the
+    chunks' noise independent. The runners in :mod:`data_minimization_tools.worker` do so for every batch.
+
+    :param data: input data as list of dicts
+    :param keys: list of keys whose values should be perturbed
+    :param scale: the noise's scale, i.e. the standard deviation for ``"gaussian"`` and the diversity for ``"laplace"``.
+                  Pass a dict to set the scale per key.
+    :param distribution: ``"laplace"`` or ``"gaussian"``
+    :param seed: an int, a :class:`numpy.random.SeedSequence` or None for fresh entropy
+    :return: cleaned list of dicts. Note, that perturbed values are floats.
+    """
+    if isinstance(keys, str):
+        keys = [keys]
+    if distribution not in ("laplace", "gaussian"):
+        raise ValueError(f"Unsupported distribution {distribution!r}, use 'laplace' or 'gaussian'.")
+    if not isinstance(seed, SeedSequence):
+        seed = SeedSequence(seed)
+
+    # one stream per key name, so that the noise of one key depends neither on the other keys nor on their order
+    for key in keys:
+        references = [(container, leaf_key) for container, leaf_key in _collect_references(data, key)
+                      if container[leaf_key] is not None]
+        values = np.fromiter((container[leaf_key] for container, leaf_key in references), dtype=float,
+                             count=len(references))
+        key_scale = scale[key] if isinstance(scale, dict) else scale
+        generator = default_rng(_child_seed(seed, _stable_hash(key)))
+        if distribution == "laplace":
+            noise = generator.laplace(0.0, key_scale, len(values))
+        else:
+            noise = generator.normal(0.0, key_scale, len(values))
+        for (container, leaf_key), value in zip(references, (values + noise).tolist()):
+            container[leaf_key] = value
+    return data
+
+
 @check_input_type
 def reduce_to_mean(data: [dict], keys):
     """
@@ -113,6 +211,179 @@ def reduce_to_nearest_value(data: [dict], keys, step_width=10):
     return _replace_with_function(data, keys, _get_nearest_value, step_width=step_width)
 
 
+@check_input_type
+def generalize_timestamps(data: [dict], keys, granularity="h", unit="s"):
+    """
+    Reduce timestamps to a coarser granularity, e.g. to the hour. Timestamps may be numbers (since the epoch), ISO 8601
+    strings or :class:`datetime.datetime` objects and keep their type, unless they are reduced to the weekday. All
+    values of a key are processed at once.
+
+    ISO 8601 strings are processed in their own local time and keep their UTC offset (e.g. ``+02:00`` or ``Z``) and
+    their precision, e.g. milliseconds. They are written with ``T`` between date and time.
+
+    :param data: input data as list of dicts
+    :param keys: list of keys whose values should be generalized
+    :param granularity: a pandas `frequency <https://pandas.pydata.org/docs/user_guide/timeseries.html#offset-aliases>`_
+                        like ``"min"``, ``"h"`` or ``"D"`` to truncate to, or ``"weekday"`` to replace the timestamp with
+                        its day of the week (Monday is 0)
+    :param unit: unit of numeric timestamps, e.g. ``"s"`` or ``"ms"``
+    :return: cleaned list of dicts
+    """
+    if isinstance(keys, str):
+        keys = [keys]
+    for key in keys:
+        references = [(container, leaf_key) for container, leaf_key in _collect_references(data, key)
+                      if container[leaf_key] is not None]
+        if not references:
+            continue
+        timestamps, to_original_type = _parse_timestamps([container[leaf_key] for container, leaf_key in references],
+                                                         unit)
+        if granularity == "weekday":
+            values = timestamps.dayofweek.tolist()
+        else:
+            values = to_original_type(timestamps.floor(granularity))
+        for (container, leaf_key), value in zip(references, values):
+            container[leaf_key] = value
+    return data
+
+
+@check_input_type
+def shift_timestamps(data: [dict], keys, max_shift=3600, journey_key=None, seed=None, unit="s"):
+    """
+    Shift timestamps by a random offset. All timestamps of a journey are shifted by the same offset, so that the
+    durations within a journey are preserved. For the supported types of timestamps, see
+    :func:`generalize_timestamps`.
+
+    The offset of a journey is derived from the seed and the journey's id (compared by its string representation)
+    only. With a seed, a journey therefore gets the same offset in every call, e.g. when its items are spread over
+    several batches. Without a seed, every call draws new offsets.
+
+    ISO 8601 strings must contain a time, as dates alone cannot be shifted by seconds. Strings that end with the hour or
+    minute are written with seconds.
+
+    :param data: input data as list of dicts
+    :param keys: list of keys whose values should be shifted
+    :param max_shift: maximum offset in seconds (in both directions). Offsets are whole seconds.
+    :param journey_key: key that identifies the journey of an item. If None, all items are one journey.
+    :param seed: seed for the random offsets, an int or a :class:`numpy.random.SeedSequence`
+    :param unit: unit of numeric timestamps, e.g. ``"s"`` or ``"ms"``
+    :return: cleaned list of dicts
+    :raises ValueError: if an ISO 8601 string contains a date only
+    """
+    if isinstance(keys, str):
+        keys = [keys]
+    if not isinstance(seed, SeedSequence):
+        seed = SeedSequence(seed)
+    journeys = {}
+    journey_of_item = [journeys.setdefault(item.get(journey_key) if journey_key else None, len(journeys))
+                       for item in data]
+    offsets = pd.to_timedelta([default_rng(_child_seed(seed, _stable_hash(journey))).integers(-max_shift, max_shift,
+                                                                                              endpoint=True)
+                               for journey in journeys], unit="s")
+
+    for key in keys:
+        if journey_key is None:
+            references = _collect_references(data, key)
+            journey_indices = np.zeros(len(references), dtype=int)
+        else:
+            references, journey_indices = [], []
+            for item, journey in zip(data, journey_of_item):
+                item_references = _collect_references([item], key)
+                references.extend(item_references)
+                journey_indices.extend([journey] * len(item_references))
+            journey_indices = np.array(journey_indices, dtype=int)
+
+        not_none = np.array([container[leaf_key] is not None for container, leaf_key in references], dtype=bool)
+        references = [reference for reference, keep in zip(references, not_none) if keep]
+        if not references:
+            continue
+        timestamps, to_original_type = _parse_timestamps([container[leaf_key] for container, leaf_key in references],
+                                                         unit, min_precision="s")
+        values = to_original_type(timestamps + offsets[journey_indices[not_none]])
+        for (container, leaf_key), value in zip(references, values):
+            container[leaf_key] = value
+    return data
+
+
+def _parse_timestamps(values: list, unit: str, min_precision: str = None):
+    """
+    helper function. Sould not be used from the api.
+
+    :param values: timestamps of the same type
+    :param unit: unit of numeric timestamps
+    :param min_precision: coarsest precision ISO 8601 strings are written with, one of :data:`_ISO_PRECISIONS`.
+        Strings that contain a date only are rejected if given.
+    :return: the timestamps as :class:`pandas.DatetimeIndex` and a function that converts such an index back to a
+             list of timestamps of the original type
+    """
+    first = values[0]
+    if isinstance(first, numbers.Number):
+        timestamps = pd.to_datetime(np.asarray(values), unit=unit)
+        all_integers = all(isinstance(value, numbers.Integral) for value in values)
+
+        def to_original_type(index: pd.DatetimeIndex) -> list:
+            since_epoch = (index - pd.Timestamp(0)) / pd.Timedelta(1, unit=unit)
+            return since_epoch.astype(np.int64).tolist() if all_integers else since_epoch.tolist()
+    elif isinstance(first, str):
+        # keep the UTC offsets aside and process the local times, which numpy parses in any version
+        offset_matches = [_UTC_OFFSET_PATTERN.search(value) if "T" in value or " " in value else None
+                          for value in values]
+        offsets = [match.group(0) if match else "" for match in offset_matches]
+        local_times = [value[:match.start()] if match else value for value, match in zip(values, offset_matches)]
+        timestamps = pd.DatetimeIndex(np.array(local_times, dtype="datetime64[ns]"))
+        precisions = [_iso_precision(local_time) for local_time in local_times]
+        if min_precision is not None:
+            if "D" in precisions:
+                raise ValueError(f"{values[precisions.index('D')]!r} contains a date only, expected a time as well.")
+            precisions = [max(precision, min_precision, key=_ISO_PRECISIONS.index) for precision in precisions]
+        precisions = np.array(precisions)
+
+        def to_original_type(index: pd.DatetimeIndex) -> list:
+            local_times = index.to_numpy()
+            strings = np.empty(len(index), dtype=object)
+            for precision in np.unique(precisions):
+                selected = precisions == precision
+                strings[selected] = np.datetime_as_string(local_times[selected], unit=precision)
+            return [string + offset for string, offset in zip(strings, offsets)]
+    elif isinstance(first, datetime.datetime):
+        timestamps = pd.DatetimeIndex(pd.to_datetime(values))
+
+        def to_original_type(index: pd.DatetimeIndex) -> list:
+            return list(index.to_pydatetime())
+    else:
+        raise TypeError(f"Unsupported timestamp {first!r}, expected a number, a string or a datetime.")
+    return timestamps, to_original_type
+
+
+def _iso_precision(timestamp: str) -> str:
+    """
+    helper function. Sould not be used from the api.
+
+    :param timestamp: ISO 8601 string without UTC offset
+    :return: the numpy unit of its last component, e.g. ``"s"`` for ``"2020-09-13T12:28:43"``
+    """
+    time = timestamp[11:]
+    if not time:
+        return "D"
+    components = time.split(":")
+    if len(components) < 3:
+        return ["h", "m"][len(components) - 1]
+    fraction = components[2].partition(".")[2]
+    if not fraction:
+        return "s"
+    return "ms" if len(fraction) <= 3 else "us" if len(fraction) <= 6 else "ns"
+
+
+def _stable_hash(value) -> int:
+    """
+    helper function. Sould not be used from the api.
+
+    :param value:
+    :return: a hash of the value's string representation that, unlike :func:`hash`, is the same in every process
+    """
+    return int.from_bytes(hashlib.sha256(str(value).encode("utf8")).digest()[:8], "big")
+
+
 def _reset_value(value):
     """
     helper function. Sould not be used from the api.
@@ -122,10 +393,10 @@ def _reset_value(value):
     """
     if isinstance(value, str):
         return ""
-    elif isinstance(value, Iterable):
-        return []
-    elif isinstance(value, int):
+    elif value is None or isinstance(value, (int, float)):
         return None
+    elif isinstance(value, (list, dict, tuple, set)) or isinstance(value, Iterable):
+        return []
     else:
         return None
 
@@ -181,6 +452,120 @@ def _replace_with_function(data: [dict], keys_to_apply_to, replace_func: Callabl
     return data
 
 
+def _child_seed(seed: SeedSequence, index: int) -> SeedSequence:
+    """
+    helper function to derive a child like :meth:`numpy.random.SeedSequence.spawn` does, but without changing the
+    parent. Sould not be used from the api.
+
+    :param seed:
+    :param index:
+    :return:
+    """
+    return SeedSequence(seed.entropy, spawn_key=tuple(seed.spawn_key) + (index,), pool_size=seed.pool_size)
+
+
+def _collect_references(data: [dict], key: str, references: list = None) -> [tuple]:
+    """
+    helper function to find all values for a key (in the notation of :func:`_replace_with_function`) at once.
+    Sould not be used from the api.
+
+    :param data:
+    :param key:
+    :param references:
+    :return: list of (dict, key) tuples, each pointing to one existing value
+    """
+    if references is None:
+        references = []
+    if not isinstance(data, list):
+        return references
+
+    if "[]." in key:
+        list_key, rest = key.split("[].", 1)
+        for item in data:
+            _collect_references(_get(item, list_key), rest, references)
+        return references
+
+    parent_keys, _, leaf_key = key.rpartition(".")
+    for item in data:
+        container = _get(item, parent_keys) if parent_keys else item
+        if isinstance(container, dict) and leaf_key in container:
+            references.append((container, leaf_key))
+    return references
+
+
+def _build_key_tree(keys) -> dict:
+    """
+    helper function to turn keys in dotted string notation into a nested dict. A list is represented by a ``"[]"``
+    key, ``None`` marks a key whose whole value is meant. Sould not be used from the api.
+
+    *Example*
+        ``["A", "C.A", "C[].B"]`` ↦ ``{"A": None, "C": {"A": None, "[]": {"B": None}}}``
+
+    :param keys:
+    :return:
+    """
+    if isinstance(keys, str):
+        keys = [keys]
+    tree = {}
+    for key in keys:
+        path = []
+        for part in key.split("."):
+            if part.endswith("[]"):
+                path.extend([part[:-2], "[]"])
+            else:
+                path.append(part)
+        node = tree
+        for part in path[:-1]:
+            if node.get(part, {}) is None:
+                break  # a parent is meant as a whole already
+            node = node.setdefault(part, {})
+        else:
+            node[path[-1]] = None
+    return tree
+
+
+_NOTHING_KEPT = object()
+
+
+def _keep_tree(value, tree: dict):
+    """
+    helper function. Sould not be used from the api.
+
+    :param value:
+    :param tree: see :func:`_build_key_tree`
+    :return: a copy of value that only contains what is in tree, or :data:`_NOTHING_KEPT`
+    """
+    if tree is None:
+        return value
+    if isinstance(value, list) and "[]" in tree:
+        return [item for item in (_keep_tree(item, tree["[]"]) for item in value) if item is not _NOTHING_KEPT]
+    if isinstance(value, dict):
+        kept = {}
+        for key, subtree in tree.items():
+            if key in value:
+                kept_value = _keep_tree(value[key], subtree)
+                if kept_value is not _NOTHING_KEPT:
+                    kept[key] = kept_value
+        return kept
+    return _NOTHING_KEPT
+
+
+def _drop_tree(value, tree: dict):
+    """
+    helper function. Sould not be used from the api.
+
+    :param value:
+    :param tree: see :func:`_build_key_tree`
+    :return: a copy of value without anything that is in tree
+    """
+    if isinstance(value, list):
+        return [_drop_tree(item, tree["[]"]) for item in value] if tree.get("[]") is not None else value
+    if isinstance(value, dict):
+        return {key: (_drop_tree(item, tree[key]) if key in tree else item) for key, item in value.items()
+                if key not in tree or tree[key] is not None}
+    return value
+
+
 def _get(d, keys):
     """
     helper function to get a value from a nested dict with dotted string notation.
@@ -0,0 +1,64 @@
+import argparse
+import os
+import sys
+from itertools import chain
+
+from data_minimization_tools.worker import load_worker_config, build_pipeline, run_pipeline, read_records, \
+    write_records, numeric_keys
+
+BUFFER_SIZE = 1 << 20
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m data_minimization_tools",
+                                     description="Apply a worker config (e.g. as generated by config_creation) to "
+                                                 "JSONL or CSV records.")
+    parser.add_argument("config", help="path to the yaml worker config.")
+    parser.add_argument("inputs", nargs="*", default=["-"], help="input files. Reads from stdin if omitted or '-'.")
+    parser.add_argument("-o", "--output", default="-", help="output file. Writes to stdout if omitted or '-'.")
+    parser.add_argument("--input-format", choices=["jsonl", "csv"],
+                        help="format of the input. Guessed from the first input's file extension, defaults to jsonl.")
+    parser.add_argument("--output-format", choices=["jsonl", "csv"],
+                        help="format of the output. Defaults to the input format.")
+    parser.add_argument("--batch-size", type=_positive_int, default=1000, help="number of records processed at once.")
+    parser.add_argument("--workers", type=_positive_int, default=1, help="number of worker processes.")
+
+    args = parser.parse_args(argv)
+
+    input_format = args.input_format or _guess_format(args.inputs[0])
+    output_format = args.output_format or input_format
+    worker_config = load_worker_config(args.config)
+    pipeline = build_pipeline(worker_config)
+    numeric_columns = numeric_keys(worker_config)
+
+    input_streams = [_open(path, "r") for path in args.inputs]
+    output_stream = _open(args.output, "w")
+    try:
+        records = chain.from_iterable(read_records(stream, input_format, numeric_columns) for stream in input_streams)
+        batches = run_pipeline(records, pipeline, batch_size=args.batch_size, workers=args.workers)
+        write_records(output_stream, batches, output_format)
+    finally:
+        for stream in input_streams + [output_stream]:
+            stream.close()
+
+
+def _positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+def _guess_format(path):
+    return "csv" if os.path.splitext(path)[1].lower() == ".csv" else "jsonl"
+
+
+def _open(path, mode):
+    if path == "-":
+        std_stream = sys.stdin if mode == "r" else sys.stdout
+        return open(std_stream.fileno(), mode, buffering=BUFFER_SIZE, newline="", closefd=False)
+    return open(path, mode, buffering=BUFFER_SIZE, newline="")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,31 @@
 import csv
 import inspect
 import os
+import shutil
 import subprocess
+import tempfile
 import textwrap
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from typing import Iterable
 from warnings import warn
 
+import numpy as np
+
+from data_minimization_tools.cvdi.cache import CvdiResultCache
+from data_minimization_tools.cvdi.results import CvdiRunStatistics, CvdiSetupException, PermanentCvdiException, \
+    RetryableCvdiException, parse_statistics
 from data_minimization_tools.utils import check_input_type
-from data_minimization_tools.utils import generate_cvdi_config
+from data_minimization_tools.utils import generate_cvdi_config, get_cvdi_settings
 
 REQUIRED_KEYS = {"Latitude", "Longitude", "Heading", "Speed",
                  "Gentime"}  #: The keys required to be present in the input data for de-identification to work.
 
 
 @check_input_type
-def anonymize_journey(data: [dict], original_to_cvdi_key: dict, config_overrides: dict = None) -> [dict]:
+def anonymize_journey(data: [dict], original_to_cvdi_key: dict, config_overrides: dict = None,
+                      cache: CvdiResultCache = None) -> [dict]:
     """
     Anonymize a journey using the `U.S. DoT's Privacy Protection Application <https://github.com/usdot-its-jpo-data-portal/privacy-protection-application>`_.
 
@@ -35,31 +46,150 @@ def anonymize_journey(data: [dict], original_to_cvdi_key: dict, config_overrides
         fields, see :py:data:`REQUIRED_KEYS`.
     :param config_overrides: Overrides to the de-identification application's settings. For example, to increase the
         length of privacy intervals to 300m, provide ``{"max_direct_distance": 300, "max_manhattan_distance: 300}``.
+        With ``plot_kml``, the KML files are written to ``./cvdi-consume/``.
+    :param cache: Reuse the result of an earlier run for identical input, see :class:`CvdiResultCache`. Note that
+        cached results do not get a fresh randomization of their privacy intervals.
     :return: A new, shorter, list of dictionaries representing the waypoints of the de-identified journey.
+    :raises PermanentCvdiException: if the journey cannot be anonymized, e.g. because it is too short.
+    :raises CvdiSetupException: if CV-DI is not set up correctly, e.g. because the quad file is missing.
+    :raises RetryableCvdiException: if the run failed for other reasons and might succeed when run again.
+    """
+    processed_data, _ = anonymize_journey_with_statistics(data, original_to_cvdi_key, config_overrides, cache)
+    return processed_data
+
+
+@check_input_type
+def anonymize_journey_with_statistics(data: [dict], original_to_cvdi_key: dict, config_overrides: dict = None,
+                                      cache: CvdiResultCache = None) -> ([dict], CvdiRunStatistics):
+    """
+    Like :func:`anonymize_journey`, but additionally returns the statistics of the CV-DI run.
+
+    :return: the de-identified journey and the :class:`~data_minimization_tools.cvdi.results.CvdiRunStatistics` of
+        the run. The statistics are None if the result was taken from the cache.
     """
+    if config_overrides is None:
+        config_overrides = {}
+
+    validate_key_mapping(original_to_cvdi_key)
+
+    script_abs_directory = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+    current_working_directory = os.getcwd()
+    executable_path = os.path.join(script_abs_directory, "bin/cv_di")
+    config_dir, out_dir = make_directories(current_working_directory)
+    quad_file_path = os.path.join(config_dir, "quad")
+
+    # every run gets directories of its own, so that several journeys can be processed at the same time
+    run_config_dir = tempfile.mkdtemp(dir=config_dir)
+    run_out_dir = tempfile.mkdtemp(dir=out_dir)
+    statistics = None
     try:
-        if config_overrides is None:
-            config_overrides = {}
+        write_data(run_config_dir, data, original_to_cvdi_key)
+        write_config(run_config_dir, config_overrides, data, original_to_cvdi_key)
+
+        cache_key, processed_data = _read_cached_result(cache, run_config_dir, quad_file_path)
+        if processed_data is None:
+            start = time.perf_counter()
+            cvdi_process = run_cvdi(executable_path, run_config_dir, run_out_dir, quad_file_path)
+            statistics = check_process_logs(cvdi_process, time.perf_counter() - start)
+
+            try:
+                result_file_path = find_result_file(run_out_dir)
+            except Exception as err:
+                raise RetryableCvdiException(str(err), statistics) from err
+            processed_data = read_result_file(result_file_path)
+            statistics = statistics._replace(points_out=len(processed_data))
+            _store_result(cache, cache_key, result_file_path)
+    finally:
+        shutil.rmtree(run_config_dir, ignore_errors=True)
+        if config_overrides.get("plot_kml"):
+            _move_kml_files(run_out_dir, out_dir)
+        shutil.rmtree(run_out_dir, ignore_errors=True)
+
+    return _revert_dict_preparation_for_cvdi_consumption(processed_data, data, original_to_cvdi_key), statistics
+
+
+def anonymize_journeys(data: [dict], original_to_cvdi_key: dict, config_overrides: dict = None, max_workers=None,
+                       cache: CvdiResultCache = None, **segmentation_kwargs) -> [dict]:
+    """
+    Split a stream of waypoints into trips (see :func:`segment_journey`) and anonymize them in parallel (see
+    :func:`anonymize_journey`).
 
-        validate_key_mapping(original_to_cvdi_key)
+    :param data: input data as list of dicts.
+    :param original_to_cvdi_key: see :func:`anonymize_journey`
+    :param config_overrides: see :func:`anonymize_journey`. Also used for segmentation.
+    :param max_workers: number of trips processed at the same time. Defaults to the number of CPUs.
+    :param cache: see :func:`anonymize_journey`
+    :param segmentation_kwargs: additional arguments for :func:`segment_journey`
+    :return: the de-identified waypoints of all trips. Trips that cannot be anonymized are left out.
+    :raises RetryableCvdiException: if any trip failed for reasons that might go away when run again.
+    :raises CvdiSetupException: if CV-DI is not set up correctly. No trip is left out for that reason.
+    """
+    def anonymize_trip(trip):
+        try:
+            return anonymize_journey(trip, original_to_cvdi_key, config_overrides, cache)
+        except PermanentCvdiException as err:  # only the trip's fault, setup failures propagate
+            warn(f"Dropping a trip of {len(trip)} points that cannot be anonymized: {err}", RuntimeWarning)
+            return []
 
-        script_abs_directory = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
-        current_working_directory = os.getcwd()
-        executable_path = os.path.join(script_abs_directory, "bin/cv_di")
-        config_dir, out_dir = make_directories(current_working_directory)
+    trips = segment_journey(data, original_to_cvdi_key, config_overrides, **segmentation_kwargs)
+    with ThreadPoolExecutor(max_workers or os.cpu_count()) as executor:
+        return list(chain.from_iterable(executor.map(anonymize_trip, trips)))
+
+
+def segment_journey(data: [dict], original_to_cvdi_key: dict, config_overrides: dict = None, max_gap: float = 300.0,
+                    device_key: str = None, gentime_unit: float = 1e-6, min_points: int = 2) -> [[dict]]:
+    """
+    Split a stream of waypoints, e.g. a multi-day trace of a device, into separate trips. A trip ends
 
-        write_data(config_dir, data, original_to_cvdi_key)
-        write_config(config_dir, config_overrides, data, original_to_cvdi_key)
+    - where the time between two consecutive points exceeds ``max_gap``,
+    - where the vehicle stops, i.e. where its speed stays at or below ``stop_max_speed`` for at least
+      ``stop_max_time`` minutes (both taken from the CV-DI settings, see :func:`anonymize_journey`), and
+    - where the device changes, if a ``device_key`` is given.
 
-        cvdi_process = run_cvdi(executable_path, config_dir, out_dir)
-        check_process_logs(cvdi_process)
+    The points of a stop are not part of any trip.
 
-        processed_data = read_results(out_dir)
+    :param data: input data as list of dicts.
+    :param original_to_cvdi_key: see :func:`anonymize_journey`. The fields mapped to ``Gentime`` and ``Speed`` are used.
+    :param config_overrides: see :func:`anonymize_journey`
+    :param max_gap: maximum time between two points of a trip in seconds
+    :param device_key: key of the input data that identifies the device. Points are expected to be of one device if
+        omitted.
+    :param gentime_unit: length of one unit of the ``Gentime`` field in seconds. Defaults to microseconds.
+    :param min_points: trips with fewer points are dropped
+    :return: list of trips, each a list of waypoints ordered by time
+    """
+    settings = get_cvdi_settings(config_overrides or {})
+    cvdi_to_original_key = {cvdi_key: original_key for original_key, cvdi_key in original_to_cvdi_key.items()}
+    time_key, speed_key = cvdi_to_original_key["Gentime"], cvdi_to_original_key["Speed"]
 
-        return _revert_dict_preparation_for_cvdi_consumption(processed_data, data, original_to_cvdi_key)
-    except Exception as err:
-        print(err)
+    points = [item for item in data if all(original_key in item for original_key in original_to_cvdi_key)]
+    if not points:
         return []
+    times = np.fromiter((item[time_key] for item in points), dtype=float, count=len(points)) * gentime_unit
+    speeds = np.array([item[speed_key] for item in points], dtype=float)
+    if device_key is None:
+        devices = np.zeros(len(points), dtype=int)
+    else:
+        devices = np.unique([str(item.get(device_key)) for item in points], return_inverse=True)[1]
+
+    order = np.lexsort((times, devices))
+    times, speeds, devices = times[order], speeds[order], devices[order]
+
+    device_change = np.r_[True, devices[1:] != devices[:-1]]
+    gap = np.r_[False, np.diff(times) > max_gap]
+    slow = speeds <= settings["stop_max_speed"]
+
+    # runs of consecutive slow (or fast) points, a stop is a slow run that lasts long enough
+    new_run = device_change | gap | np.r_[True, slow[1:] != slow[:-1]]
+    run_starts = np.flatnonzero(new_run)
+    run_ends = np.r_[run_starts[1:], len(times)] - 1
+    is_stop = slow[run_starts] & (times[run_ends] - times[run_starts] >= settings["stop_max_time"] * 60)
+    stopped = is_stop[np.cumsum(new_run) - 1]
+
+    new_trip = device_change | gap | np.r_[False, stopped[:-1]]
+    trip_ids = np.cumsum(new_trip)[~stopped]
+    trip_indices = np.split(order[~stopped], np.flatnonzero(np.diff(trip_ids)) + 1)
+    return [[points[index] for index in indices] for indices in trip_indices if len(indices) >= min_points]
 
 
 def validate_key_mapping(original_to_cvdi_key):
@@ -76,10 +206,17 @@ def validate_key_mapping(original_to_cvdi_key):
 
 
 def read_results(out_dir):
+    return read_result_file(find_result_file(out_dir))
+
+
+def find_result_file(out_dir):
     processed_data_candidates = [name for name in os.listdir(out_dir) if name.endswith(".csv")]
     if len(processed_data_candidates) != 1:
         raise Exception(f"Expected exactly one produced CSV file in {out_dir}, found {processed_data_candidates}.")
-    processed_data_file_name = os.path.join(out_dir, processed_data_candidates[0])
+    return os.path.join(out_dir, processed_data_candidates[0])
+
+
+def read_result_file(processed_data_file_name):
     with open(processed_data_file_name) as csvfile:
         cvdi_processed_data = [{
             # hackily restore original types instead of parsing everything as string
@@ -88,17 +225,27 @@ def read_results(out_dir):
     return cvdi_processed_data
 
 
-def run_cvdi(executable_path, config_dir, out_dir):
+def run_cvdi(executable_path, config_dir, out_dir, quad_file_path=None):
     def _run_cvdi(binary_path: str):
-        call = [binary_path, *_get_cvdi_args(config_dir, out_dir)]
+        call = [binary_path, *_get_cvdi_args(config_dir, out_dir, quad_file_path)]
         print(f"Calling {call}")
         return subprocess.run(call, check=True, capture_output=True)
 
     try:
-        cvdi_process = _run_cvdi(executable_path)
-    except OSError:
-        # assuming running on windows
-        cvdi_process = _run_cvdi(executable_path + ".exe")
+        try:
+            cvdi_process = _run_cvdi(executable_path)
+        except OSError:
+            # assuming running on windows
+            cvdi_process = _run_cvdi(executable_path + ".exe")
+    except subprocess.CalledProcessError as err:
+        # a negative return code means the process was killed by a signal, e.g. because memory ran out
+        exception_type = RetryableCvdiException if err.returncode < 0 else PermanentCvdiException
+        raise exception_type(f"CV-DI exited with {err.returncode}, message was: {err.stderr.splitlines()}",
+                             parse_statistics(err.stderr or b"", 0.0)) from err
+    except (FileNotFoundError, PermissionError) as err:
+        raise CvdiSetupException(f"CV-DI could not be started: {err}") from err
+    except OSError as err:
+        raise RetryableCvdiException(f"CV-DI could not be started: {err}") from err
     return cvdi_process
 
 
@@ -116,7 +263,7 @@ def make_directories(current_working_directory):
 def write_data(config_dir, data, original_to_cvdi_key):
     data_for_cvdi = _prepare_dicts_for_cvdi_consumption(data, original_to_cvdi_key)
     if len(data_for_cvdi) == 0:
-        raise Exception("No data was sent to cv-di.")
+        raise PermanentCvdiException("No data was sent to cv-di.")
     with open(os.path.join(config_dir, "THE_FILE.csv"), "w+") as data_file:
         fieldnames = [key for key in data_for_cvdi[0]]
         writer = csv.DictWriter(data_file, fieldnames, dialect=csv.excel)
@@ -134,13 +281,21 @@ def write_config(config_dir, cvdi_overrides, data, original_to_cvdi_key):
         data_file_list_file.write(os.path.join(data_file_path, "THE_FILE.csv"))
 
 
-def check_process_logs(process):
-    if process.stderr[-106:-93] == b"0,0,0,0,0,0,0":
-        raise Exception(f"CV-DI processed exactly 0 lines, "
-                        f"message was: {process.stderr.splitlines()}")
-    if process.stderr[-95:-93] == b",0":
-        raise Exception(f"CV-DI produced exactly 0 points as part of a privacy interval, "
-                        f"message was: {process.stderr.splitlines()}")
+def check_process_logs(process, run_time=0.0) -> CvdiRunStatistics:
+    statistics = parse_statistics(process.stderr, run_time)
+    if b"Could not open shape file" in process.stderr:
+        raise CvdiSetupException(f"CV-DI could not read the quad file, "
+                                 f"message was: {process.stderr.splitlines()}", statistics)
+    if statistics is None:
+        raise RetryableCvdiException(f"CV-DI did not report any statistics, "
+                                     f"message was: {process.stderr.splitlines()}")
+    if statistics.points_in == 0:
+        raise PermanentCvdiException(f"CV-DI processed exactly 0 lines, "
+                                     f"message was: {process.stderr.splitlines()}", statistics)
+    if statistics.privacy_interval_points == 0:
+        raise PermanentCvdiException(f"CV-DI produced exactly 0 points as part of a privacy interval, "
+                                     f"message was: {process.stderr.splitlines()}", statistics)
+    return statistics
 
 
 def _prepare_dicts_for_cvdi_consumption(data: [dict], geodata_key_map: dict):
@@ -192,19 +347,22 @@ def _revert_dict_preparation_for_cvdi_consumption(cvdi_output: [dict], original_
     :param original_data:
     :param geodata_key_map:
     :return:
+    :raises PermanentCvdiException: if the cv-di output contains a point that is not part of the original data.
     """
     cvdi_key_to_join_by = "Gentime"
     original_key_to_join_by = next(original_key for original_key, cvdi_key in geodata_key_map.items()
                                    if cvdi_key == cvdi_key_to_join_by)
 
-    def is_join_match(cvdi_item, original_item):
-        return cvdi_item[cvdi_key_to_join_by] == original_item[original_key_to_join_by]
-
     # gentime is unique for one journey --> inner one to one join, throw away remaining original_data
-    joint = [(
-        next(original_item for original_item in original_data if is_join_match(cvdi_item, original_item)),
-        cvdi_item
-    ) for cvdi_item in cvdi_output]
+    original_by_join_key = {}
+    for original_item in original_data:
+        if original_key_to_join_by in original_item:
+            original_by_join_key.setdefault(original_item[original_key_to_join_by], original_item)
+    try:
+        joint = [(original_by_join_key[cvdi_item[cvdi_key_to_join_by]], cvdi_item) for cvdi_item in cvdi_output]
+    except KeyError as err:
+        raise PermanentCvdiException(f"CV-DI returned a point with {cvdi_key_to_join_by} {err}, which is not part of "
+                                     f"the journey.") from err
 
     return [{
         **original_item,
@@ -212,9 +370,57 @@ def _revert_dict_preparation_for_cvdi_consumption(cvdi_output: [dict], original_
     } for original_item, cvdi_processed_item in joint]
 
 
-def _get_cvdi_args(config_dir, out_dir) -> Iterable:
+def _read_cached_result(cache: CvdiResultCache, config_dir, quad_file_path):
+    """
+    helper function to look up the result of a run in the cache. Sould not be used from the api.
+
+    :param cache: the cache or None
+    :param config_dir: the run's config directory, see :func:`write_data` and :func:`write_config`
+    :param quad_file_path:
+    :return: the run's cache key and the cached result, each None if not available
+    """
+    if cache is None:
+        return None, None
+    cache_key = cache.key_for(os.path.join(config_dir, "THE_FILE.csv"), os.path.join(config_dir, "config"),
+                              quad_file_path)
+    cached_result_path = cache.get(cache_key)
+    if cached_result_path is None:
+        return cache_key, None
+    try:
+        return cache_key, read_result_file(cached_result_path)
+    except FileNotFoundError:
+        return cache_key, None  # evicted in the meantime
+
+
+def _store_result(cache: CvdiResultCache, cache_key, result_file_path):
+    """
+    helper function to store the result of a run in the cache. A result that cannot be stored, e.g. because the disk is
+    full, is only warned about. Sould not be used from the api.
+    """
+    if cache is None:
+        return
+    try:
+        cache.put(cache_key, result_file_path)
+    except OSError as err:
+        warn(f"Could not store the CV-DI result in the cache: {err}", RuntimeWarning)
+
+
+def _move_kml_files(run_out_dir, out_dir):
+    """
+    helper function to keep the KML files of a run where CV-DI used to write them. Sould not be used from the api.
+
+    :param run_out_dir: the run's own output directory
+    :param out_dir: the shared output directory, see :func:`make_directories`
+    """
+    for name in os.listdir(run_out_dir):
+        if name.endswith(".kml"):
+            os.replace(os.path.join(run_out_dir, name), os.path.join(out_dir, name))
+
+
+def _get_cvdi_args(config_dir, out_dir, quad_file_path=None) -> Iterable:
     config_file_path = os.path.join(config_dir, "config")
-    quad_file_path = os.path.join(config_dir, "quad")
+    if quad_file_path is None:
+        quad_file_path = os.path.join(config_dir, "quad")
     data_file_list_file_path = os.path.join(config_dir, "data_file_list")
     return ["-n",
             "-c", config_file_path,
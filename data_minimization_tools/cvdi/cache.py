@@ -0,0 +1,132 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class CvdiResultCache:
+    """
+    Size-bounded on-disk cache of CV-DI results, for example to avoid processing redelivered journeys again.
+
+    Results are keyed by a hash of the exact input CSV, the exact config and the identity (path, size and modification
+    time) of the quad file, so a result is only served for identical input. When the cache grows beyond
+    ``max_bytes``, the least recently used results are removed.
+
+    The bound holds for the directory, also if several instances (e.g. of several processes) share it. The sizes of
+    the stored results are tracked in memory and read from the directory again whenever another instance stored or
+    removed a result in the meantime. A change another instance makes at the very moment this instance stores a
+    result is only noticed with the next change, so the directory might exceed ``max_bytes`` by a few results briefly.
+
+    .. warning::
+        CV-DI randomizes the privacy intervals (see the ``rand_*`` settings). A cached result repeats the same
+        randomization for the same input instead of drawing a new one, i.e. processing a journey twice no longer
+        reveals two differently anonymized versions of it, but the randomization is not refreshed either.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30):
+        """
+        :param directory: directory to store the results in. It is created if it does not exist.
+        :param max_bytes: maximum total size of all stored results
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # temporary files go to a directory of their own, so that only stored and removed results change the mtime
+        # of the directory
+        self._temporary_directory = os.path.join(directory, "tmp")
+        os.makedirs(self._temporary_directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._sizes = OrderedDict()  # key -> size, least recently used first
+        self._total_size = 0
+        self._directory_mtime = None  # mtime of the directory when the sizes were last known to be complete
+        with self._lock:
+            self._scan()
+
+    @staticmethod
+    def key_for(data_file_path: str, config_file_path: str, quad_file_path: str) -> str:
+        """
+        :return: the cache key for a CV-DI run with the given files
+        """
+        digest = hashlib.sha256()
+        for path in data_file_path, config_file_path:
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(1 << 16), b""):
+                    digest.update(chunk)
+            digest.update(b"\0")
+        quad_stat = os.stat(quad_file_path)
+        digest.update(f"{os.path.abspath(quad_file_path)}:{quad_stat.st_size}:{quad_stat.st_mtime_ns}".encode("utf8"))
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """
+        :return: path of the cached result CSV for the key or None
+        """
+        path = self._path(key)
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            with self._lock:
+                self._forget(key)  # removed by another instance
+            return None
+        with self._lock:
+            if key in self._sizes:
+                self._sizes.move_to_end(key)
+        return path
+
+    def put(self, key: str, result_file_path: str):
+        """
+        Store a copy of the result CSV under the key and evict old results if necessary.
+        """
+        file_descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=self._temporary_directory)
+        try:
+            with os.fdopen(file_descriptor, "wb") as temporary_file, open(result_file_path, "rb") as result_file:
+                shutil.copyfileobj(result_file, temporary_file)
+            size = os.path.getsize(temporary_path)
+            with self._lock:
+                if os.stat(self.directory).st_mtime_ns != self._directory_mtime:
+                    self._scan()  # another instance stored or removed results
+                os.replace(temporary_path, self._path(key))
+                self._forget(key)
+                self._sizes[key] = size
+                self._total_size += size
+                while self._total_size > self.max_bytes and self._sizes:
+                    evicted_key, evicted_size = self._sizes.popitem(last=False)
+                    self._total_size -= evicted_size
+                    try:
+                        os.remove(self._path(evicted_key))
+                    except FileNotFoundError:
+                        pass
+                self._directory_mtime = os.stat(self.directory).st_mtime_ns
+        except BaseException:
+            try:
+                os.remove(temporary_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def _scan(self):
+        """
+        Read the sizes of all stored results from the directory, least recently used first. Must hold the lock.
+        """
+        self._directory_mtime = os.stat(self.directory).st_mtime_ns
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".csv"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, entry.name[:-len(".csv")], stat.st_size))
+        self._sizes.clear()
+        self._total_size = 0
+        for _, key, size in sorted(entries):
+            self._sizes[key] = size
+            self._total_size += size
+
+    def _forget(self, key: str):
+        self._total_size -= self._sizes.pop(key, 0)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.csv")
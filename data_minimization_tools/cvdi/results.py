@@ -0,0 +1,68 @@
+from typing import NamedTuple, Optional
+
+#: Header of the summary CV-DI prints to stderr when called with ``-n``.
+STATISTICS_HEADER = "total,invalid_fields,invalid_GPS,invalid_heading,error,critical_interval,privacy_interval"
+
+
+class CvdiException(Exception):
+    """
+    CV-DI could not anonymize a journey. Holds the run's :class:`CvdiRunStatistics` if there are any.
+    """
+
+    def __init__(self, message, statistics: "CvdiRunStatistics" = None):
+        super().__init__(message)
+        self.statistics = statistics
+
+
+class RetryableCvdiException(CvdiException):
+    """
+    The run failed for reasons unrelated to the journey, e.g. the process was killed. Running it again might succeed.
+    """
+
+
+class PermanentCvdiException(CvdiException):
+    """
+    The journey cannot be anonymized as is, e.g. because it is too short to contain a privacy interval. Running it
+    again will fail again.
+    """
+
+
+class CvdiSetupException(CvdiException):
+    """
+    CV-DI is not set up correctly, e.g. the quad file or the executable is missing. Every journey fails until the setup
+    is fixed.
+    """
+
+
+class CvdiRunStatistics(NamedTuple):
+    """
+    Summary of a CV-DI run. The point counts are taken from the summary CV-DI prints.
+    """
+    points_in: int  #: number of points read
+    invalid_fields: int  #: points dropped because of an invalid number of fields
+    invalid_gps: int  #: points dropped because of invalid coordinates
+    invalid_heading: int  #: points dropped because of an invalid heading
+    errors: int  #: points dropped by error correction
+    critical_interval_points: int  #: points dropped as part of a critical interval
+    privacy_interval_points: int  #: points dropped as part of a privacy interval
+    points_out: Optional[int]  #: points in the result, None if no result was read
+    run_time: float  #: wall clock time of the CV-DI process in seconds
+
+
+def parse_statistics(stderr: bytes, run_time: float) -> Optional[CvdiRunStatistics]:
+    """
+    :param stderr: the stderr output of a CV-DI run with ``-n``
+    :param run_time: wall clock time of the run in seconds
+    :return: the run's statistics, or None if stderr contains no summary
+    """
+    lines = [line.strip() for line in stderr.decode("utf8", errors="replace").splitlines()]
+    header_indices = [index for index, line in enumerate(lines[:-1]) if line == STATISTICS_HEADER]
+    if not header_indices:
+        return None
+    try:
+        counts = [int(count) for count in lines[header_indices[-1] + 1].split(",")]
+    except ValueError:
+        return None
+    if len(counts) != len(STATISTICS_HEADER.split(",")):
+        return None
+    return CvdiRunStatistics(*counts, points_out=None, run_time=run_time)
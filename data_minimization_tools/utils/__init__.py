@@ -28,7 +28,12 @@ def check_input_type(func):
 
 
 def generate_cvdi_config(journey: [dict], config: dict, user_overrides: dict):
-    config = {
+    config = get_cvdi_settings(user_overrides)
+    return "\n".join([f"{key}:{value}" for key, value in config.items()])
+
+
+def get_cvdi_settings(user_overrides: dict) -> dict:
+    return {
         # Things we need to change
         "quad_sw_lat": 51.6280977,
         "quad_sw_lng": 10.4713459,
@@ -59,4 +64,3 @@ def generate_cvdi_config(journey: [dict], config: dict, user_overrides: dict):
         "rand_out_degree": 0,
         **user_overrides
     }
-    return "\n".join([f"{key}:{value}" for key, value in config.items()])
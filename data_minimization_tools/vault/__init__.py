@@ -0,0 +1,122 @@
+import os
+import secrets
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Iterable
+
+_SQLITE_MAX_VARIABLES = 500
+_open_vaults = threading.local()
+
+
+class PseudonymVault:
+    """
+    Persistent mapping of original values to random tokens, stored in a local SQLite file.
+
+    A value gets a new random token the first time it is seen and the same token ever after, across runs and across
+    processes sharing the file. The most recently used mappings are additionally kept in memory.
+
+    Note that the file contains the original values in plain text, so it must be protected like the original data.
+    """
+
+    def __init__(self, path: str, cache_size=100000, token_bytes=16, mmap_size=1 << 28):
+        """
+        :param path: path of the SQLite file. It is created if it does not exist.
+        :param cache_size: number of mappings kept in memory
+        :param token_bytes: number of random bytes per token. Tokens are hex encoded, i.e. twice as long.
+        :param mmap_size: number of bytes of the file SQLite may memory-map
+        """
+        self.path = path
+        self.cache_size = cache_size
+        self.token_bytes = token_bytes
+        self._cache = OrderedDict()
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS pseudonyms "
+                                 "(value TEXT PRIMARY KEY, token TEXT NOT NULL UNIQUE) WITHOUT ROWID")
+
+    def tokenize(self, value) -> str:
+        """
+        :param value: the value to tokenize. Values are compared by their string representation.
+        :return: the token of the value
+        """
+        return self.tokenize_many([value])[str(value)]
+
+    def tokenize_many(self, values: Iterable) -> dict:
+        """
+        Tokenize many values at once, using a single transaction for all values not in memory.
+
+        :param values: the values to tokenize. Values are compared by their string representation.
+        :return: mapping of the string representation of each value to its token
+        """
+        tokens = {}
+        missing = []
+        for value in {str(value) for value in values}:
+            token = self._cache.get(value)
+            if token is None:
+                missing.append(value)
+            else:
+                self._cache.move_to_end(value)
+                tokens[value] = token
+
+        if missing:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                found = self._select(missing)
+                unknown = [value for value in missing if value not in found]
+                while unknown:
+                    # INSERT OR IGNORE also skips the (unlikely) token collisions; those values get another try
+                    self._connection.executemany("INSERT OR IGNORE INTO pseudonyms (value, token) VALUES (?, ?)",
+                                                 [(value, secrets.token_hex(self.token_bytes)) for value in unknown])
+                    found.update(self._select(unknown))
+                    unknown = [value for value in unknown if value not in found]
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            tokens.update(found)
+            for value, token in found.items():
+                self._remember(value, token)
+        return tokens
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _select(self, values: [str]) -> dict:
+        found = {}
+        for start in range(0, len(values), _SQLITE_MAX_VARIABLES):
+            chunk = values[start:start + _SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(self._connection.execute(
+                f"SELECT value, token FROM pseudonyms WHERE value IN ({placeholders})", chunk))
+        return found
+
+    def _remember(self, value, token):
+        self._cache[value] = token
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+
+def open_vault(path: str, **kwargs) -> PseudonymVault:
+    """
+    Get the vault for the given file, opening it once per process and thread (SQLite connections must not be shared
+    between threads).
+
+    :param path: path of the SQLite file
+    :param kwargs: see :class:`PseudonymVault`. Only used when the vault is opened.
+    :return: the vault
+    """
+    if not hasattr(_open_vaults, "by_path"):
+        _open_vaults.by_path = {}
+    key = (os.getpid(), os.path.abspath(path))
+    if key not in _open_vaults.by_path:
+        _open_vaults.by_path[key] = PseudonymVault(path, **kwargs)
+    return _open_vaults.by_path[key]
@@ -0,0 +1,242 @@
+import csv
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+import yaml
+from numpy.random import SeedSequence
+
+#: Functions that need numbers. Their keys are parsed as numbers when reading CSV, all other columns stay strings.
+NUMERIC_SIGNATURES = {"reduce_to_mean", "reduce_to_median", "reduce_to_nearest_value", "add_noise",
+                      "generalize_timestamps", "shift_timestamps", "anonymize_journey"}
+
+#: Functions whose ``seed`` is replaced by a child seed per batch, so that batches do not repeat the same random values.
+PER_BATCH_SEEDED_SIGNATURES = {"add_noise"}
+
+
+class UnknownTaskSignatureException(Exception):
+    pass
+
+
+def load_worker_config(config_file) -> dict:
+    """
+    Load a worker config as printed by ``config_creation/generate_config.py``. The config may either be the bare
+    config (with ``task_defaults`` and ``tasks``) or be nested under a ``worker_config`` key.
+
+    :param config_file: path to or open stream of the yaml config
+    :return: the worker config as dict
+    """
+    if isinstance(config_file, str):
+        with open(config_file) as stream:
+            config = yaml.safe_load(stream)
+    else:
+        config = yaml.safe_load(config_file)
+    if "tasks" not in config and "worker_config" in config:
+        config = config["worker_config"]
+    return config
+
+
+def order_tasks(tasks: [dict]) -> [dict]:
+    """
+    Order tasks along the chain of their ``input_topic``/``output_topic`` pairs. Tasks without topics keep their
+    position in the config.
+
+    :param tasks: the ``tasks`` of a worker config
+    :return: the tasks in processing order
+    """
+    by_input_topic = {task["input_topic"]: task for task in tasks if "input_topic" in task}
+    output_topics = {task.get("output_topic") for task in tasks}
+    if len(by_input_topic) != len(tasks):
+        return list(tasks)
+
+    ordered = []
+    heads = [task for task in tasks if task["input_topic"] not in output_topics]
+    for task in heads:
+        while task is not None and task not in ordered:
+            ordered.append(task)
+            task = by_input_topic.get(task.get("output_topic"))
+    # append anything not reachable from a head (e.g. cycles) in config order
+    return ordered + [task for task in tasks if task not in ordered]
+
+
+def resolve_task(task: dict) -> Callable[[list], list]:
+    """
+    Turn a single task of a worker config into a function that processes a list of dicts.
+
+    :param task: a task with a ``function`` entry holding ``signature`` and ``args``
+    :return: a function that takes and returns a list of dicts
+    """
+    import data_minimization_tools
+
+    signature = task["function"]["signature"]
+    args = task["function"].get("args") or {}
+    func = getattr(data_minimization_tools, signature, None) if not signature.startswith("_") else None
+    if not callable(func):
+        raise UnknownTaskSignatureException(f"Unknown function signature {signature!r} in task {task.get('name')!r}.")
+    return partial(func, **args)
+
+
+def build_pipeline(worker_config: dict) -> [Callable[[list], list]]:
+    """
+    :param worker_config: worker config, see :func:`load_worker_config`
+    :return: the functions of all tasks in processing order
+    """
+    return [resolve_task(task) for task in order_tasks(worker_config["tasks"])]
+
+
+def numeric_keys(worker_config: dict) -> set:
+    """
+    :param worker_config: worker config, see :func:`load_worker_config`
+    :return: the keys the tasks of the config expect to be numbers (see :data:`NUMERIC_SIGNATURES`)
+    """
+    keys = set()
+    for task in worker_config["tasks"]:
+        if task["function"]["signature"] not in NUMERIC_SIGNATURES:
+            continue
+        args = task["function"].get("args") or {}
+        task_keys = args.get("keys", args.get("original_to_cvdi_key", []))
+        keys.update([task_keys] if isinstance(task_keys, str) else task_keys)
+    return keys
+
+
+def apply_pipeline(batch: [dict], pipeline: [Callable[[list], list]], batch_number: int = None) -> [dict]:
+    """
+    :param batch: list of dicts
+    :param pipeline: see :func:`build_pipeline`
+    :param batch_number: position of the batch in the stream. If given, functions in
+        :data:`PER_BATCH_SEEDED_SIGNATURES` get a child of their seed for this batch.
+    :return: the processed batch
+    """
+    for func in pipeline:
+        if batch_number is not None:
+            func = seed_for_batch(func, batch_number)
+        batch = func(batch)
+    return batch
+
+
+def seed_for_batch(func: Callable[[list], list], batch_number: int) -> Callable[[list], list]:
+    """
+    :param func: a function of a pipeline, see :func:`resolve_task`
+    :param batch_number: position of the batch in the stream
+    :return: the function with its seed replaced by the batch's child seed, if it is in
+        :data:`PER_BATCH_SEEDED_SIGNATURES` and has a seed
+    """
+    from data_minimization_tools import _child_seed
+
+    if not isinstance(func, partial) or func.func.__name__ not in PER_BATCH_SEEDED_SIGNATURES:
+        return func
+    seed = func.keywords.get("seed")
+    if seed is None:
+        return func  # fresh entropy on every call anyway
+    if not isinstance(seed, SeedSequence):
+        seed = SeedSequence(seed)
+    return partial(func, seed=_child_seed(seed, batch_number))
+
+
+def run_pipeline(records: Iterable[dict], pipeline: [Callable[[list], list]], batch_size=1000, workers=1) -> \
+        Iterator[list]:
+    """
+    Stream records through the pipeline in batches. Note that aggregating functions (e.g. ``reduce_to_mean``) only
+    aggregate across a single batch.
+
+    :param records: iterable of dicts
+    :param pipeline: see :func:`build_pipeline`
+    :param batch_size: number of records passed to each function at once
+    :param workers: number of processes to use. Batches are yielded in input order regardless.
+    :return: iterator over processed batches
+    """
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1, got {batch_size}.")
+    batches = _chunked(records, batch_size)
+    if workers <= 1:
+        for batch_number, batch in enumerate(batches):
+            yield apply_pipeline(batch, pipeline, batch_number)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker_process, initargs=(pipeline,)) as executor:
+        # bound the number of batches in flight, executor.map would consume the whole input eagerly
+        in_flight = deque()
+        for batch_number, batch in enumerate(batches):
+            in_flight.append(executor.submit(_apply_worker_pipeline, batch, batch_number))
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def read_records(stream, input_format="jsonl", numeric_columns=()) -> Iterator[dict]:
+    """
+    :param stream: text stream to read from
+    :param input_format: ``jsonl`` or ``csv``
+    :param numeric_columns: csv columns to parse as numbers (see :func:`numeric_keys`). All other columns are strings.
+    :return: iterator over the records as dicts
+    """
+    if input_format == "csv":
+        numeric_columns = set(numeric_columns)
+        for row in csv.DictReader(stream):
+            for key in numeric_columns.intersection(row):
+                row[key] = _parse_csv_value(row[key])
+            yield row
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_records(stream, batches: Iterable[list], output_format="jsonl"):
+    """
+    Write batches of records, one write call per batch.
+
+    :param stream: text stream to write to
+    :param batches: iterable of lists of dicts
+    :param output_format: ``jsonl`` or ``csv``. For csv, the columns are taken from the first batch. A later record
+        with additional keys raises a ValueError.
+    """
+    writer = None
+    for batch in batches:
+        if not batch:
+            continue
+        if output_format == "csv":
+            if writer is None:
+                fieldnames = list(dict.fromkeys(key for record in batch for key in record))
+                writer = csv.DictWriter(stream, fieldnames, dialect=csv.excel)
+                writer.writeheader()
+            writer.writerows(batch)
+        else:
+            stream.write("".join(json.dumps(record, default=str) + "\n" for record in batch))
+
+
+_worker_pipeline = None
+
+
+def _init_worker_process(pipeline):
+    global _worker_pipeline
+    _worker_pipeline = pipeline
+
+
+def _apply_worker_pipeline(batch, batch_number):
+    return apply_pipeline(batch, _worker_pipeline, batch_number)
+
+
+def _chunked(records: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(records)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _parse_csv_value(value):
+    # hackily restore original types instead of parsing everything as string
+    if value == "" or value is None:
+        return None
+    for parse in int, float:
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
@@ -0,0 +1,189 @@
+import asyncio
+import copy
+from collections import defaultdict
+from itertools import count
+from typing import AsyncIterator, Iterable
+
+from data_minimization_tools.worker import resolve_task, seed_for_batch, _chunked
+
+_END = object()  #: Marks the end of a topic's stream.
+
+
+class InMemoryBroker:
+    """
+    Local stand-in for the message broker. Topics are bounded in-memory queues, so publishing to a topic whose
+    subscribers are lagging behind blocks the publisher (backpressure). Messages are batches (lists) of records and
+    every subscriber of a topic receives every batch. As functions modify records in place, each subscriber but the
+    first receives a deep copy.
+    """
+
+    def __init__(self, max_queue_size=16):
+        """
+        :param max_queue_size: number of batches a topic buffers per subscriber before publishing blocks
+        """
+        self.max_queue_size = max_queue_size
+        self._subscribers = defaultdict(list)
+        self._producers = defaultdict(int)
+
+    def subscribe(self, topic: str) -> asyncio.Queue:
+        queue = asyncio.Queue(self.max_queue_size)
+        self._subscribers[topic].append(queue)
+        return queue
+
+    def register_producer(self, topic: str):
+        self._producers[topic] += 1
+
+    async def publish(self, topic: str, batch: list):
+        subscribers = self._subscribers[topic]
+        for index, queue in enumerate(subscribers):
+            await queue.put(batch if index == 0 else copy.deepcopy(batch))
+
+    async def close(self, topic: str):
+        """
+        Called by each producer once it is done. The topic ends when its last producer closed it.
+        """
+        self._producers[topic] -= 1
+        if self._producers[topic] <= 0:
+            for queue in self._subscribers[topic]:
+                await queue.put(_END)
+
+
+class IterableSource:
+    """
+    Source adapter that serves the records of a (sync or async) iterable in batches.
+    """
+
+    def __init__(self, records, batch_size=100):
+        self.records = records
+        self.batch_size = batch_size
+
+    async def __aiter__(self) -> AsyncIterator[list]:
+        if hasattr(self.records, "__aiter__"):
+            batch = []
+            async for record in self.records:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        else:
+            for batch in _chunked(self.records, self.batch_size):
+                yield batch
+                # give consumers the chance to run between batches
+                await asyncio.sleep(0)
+
+
+class ListSink:
+    """
+    Sink adapter that collects all records in :py:attr:`records`.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    async def write(self, batch: list):
+        self.records.extend(batch)
+
+
+async def run_topology(worker_config: dict, source, sink, broker: InMemoryBroker = None, batch_size=100,
+                       flush_interval=0.5):
+    """
+    Run the tasks of a worker config in-process, connected through their ``input_topic``/``output_topic`` pairs.
+
+    Each task collects incoming records into micro-batches and calls its function once per micro-batch. A batch is
+    flushed once it holds ``batch_size`` records or its oldest record waited ``flush_interval`` seconds. Note that
+    aggregating functions (e.g. ``reduce_to_mean``) only aggregate across a single micro-batch, and that functions
+    seeded per batch (see :func:`data_minimization_tools.worker.seed_for_batch`) are only reproducible if the
+    micro-batches are, i.e. if they are not flushed by time.
+
+    :param worker_config: worker config, see :func:`data_minimization_tools.worker.load_worker_config`
+    :param source: async iterable of batches (lists of dicts), e.g. :class:`IterableSource`. It is published to all
+        topics that are consumed, but not produced, by a task.
+    :param sink: object with an ``async write(batch)`` method, e.g. :class:`ListSink`. It receives all topics that
+        are produced, but not consumed, by a task. If it has an ``async close()`` method, it is called at the end.
+    :param broker: defaults to a new :class:`InMemoryBroker`
+    :param batch_size: maximum number of records per micro-batch
+    :param flush_interval: maximum time in seconds a record waits for its micro-batch to fill up
+    """
+    if broker is None:
+        broker = InMemoryBroker()
+
+    tasks = worker_config["tasks"]
+    consumed_topics = {task["input_topic"] for task in tasks}
+    produced_topics = {task["output_topic"] for task in tasks}
+    source_topics = consumed_topics - produced_topics
+    sink_topics = produced_topics - consumed_topics
+
+    # subscribe and register everything before the first message is sent, so that nothing gets lost
+    stages = [(resolve_task(task), broker.subscribe(task["input_topic"]), task["output_topic"]) for task in tasks]
+    sink_queues = [broker.subscribe(topic) for topic in sink_topics]
+    for topic in list(source_topics) + [output_topic for _, _, output_topic in stages]:
+        broker.register_producer(topic)
+
+    coroutines = [
+        _pump_source(source, broker, source_topics),
+        *[_run_stage(func, queue, broker, output_topic, batch_size, flush_interval)
+          for func, queue, output_topic in stages],
+        *[_drain_into_sink(queue, sink) for queue in sink_queues]
+    ]
+    running = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*running)
+    finally:
+        for future in running:
+            future.cancel()
+
+    if hasattr(sink, "close"):
+        await sink.close()
+
+
+async def _pump_source(source, broker: InMemoryBroker, topics: Iterable[str]):
+    async for batch in source:
+        for topic in topics:
+            await broker.publish(topic, batch)
+    for topic in topics:
+        await broker.close(topic)
+
+
+async def _run_stage(func, queue: asyncio.Queue, broker: InMemoryBroker, output_topic: str, batch_size: int,
+                     flush_interval: float):
+    loop = asyncio.get_running_loop()
+    pending = []
+    deadline = None
+    batch_numbers = count()
+    while True:
+        timeout = None if not pending else max(0.0, deadline - loop.time())
+        try:
+            message = await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            message = None
+
+        if message is _END:
+            if pending:
+                await broker.publish(output_topic, seed_for_batch(func, next(batch_numbers))(pending))
+            await broker.close(output_topic)
+            return
+
+        if message:
+            if not pending:
+                deadline = loop.time() + flush_interval
+            pending.extend(message)
+
+        # flush full batches, and whatever there is once the deadline passed
+        while len(pending) >= batch_size:
+            batch, pending = pending[:batch_size], pending[batch_size:]
+            await broker.publish(output_topic, seed_for_batch(func, next(batch_numbers))(batch))
+            deadline = loop.time() + flush_interval
+        if pending and loop.time() >= deadline:
+            batch, pending = pending, []
+            await broker.publish(output_topic, seed_for_batch(func, next(batch_numbers))(batch))
+
+
+async def _drain_into_sink(queue: asyncio.Queue, sink):
+    while True:
+        batch = await queue.get()
+        if batch is _END:
+            return
+        if batch:
+            await sink.write(batch)
@@ -12,7 +12,8 @@ setup(name='data_minimization_tools',
       long_description_content_type="text/markdown",
       author_email='peng.dataminimization@gmail.com',
       license='MIT',
-      packages=['data_minimization_tools', 'data_minimization_tools.utils', 'data_minimization_tools.cvdi'],
+      packages=['data_minimization_tools', 'data_minimization_tools.utils', 'data_minimization_tools.cvdi',
+                'data_minimization_tools.vault', 'data_minimization_tools.worker'],
       install_requires=['numpy', 'PyYAML', 'pandas'],
       include_package_data=True
       )
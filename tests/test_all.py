@@ -1,13 +1,34 @@
+import asyncio
 import csv
+import io
+import datetime
 import inspect
 import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
 import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
+import pandas as pd
+from numpy.random import SeedSequence
 from ddt import ddt, data, unpack, file_data
 from fitparse import FitFile
 
-from data_minimization_tools import reduce_to_median, reduce_to_nearest_value, drop_keys
-from data_minimization_tools.cvdi import anonymize_journey
+from config_creation import generate_config
+from data_minimization_tools import reduce_to_median, reduce_to_nearest_value, drop_keys, tokenize_keys, \
+    add_noise, project_keys, generalize_timestamps, shift_timestamps
+from data_minimization_tools import cvdi
+from data_minimization_tools.cvdi import anonymize_journey, segment_journey, check_process_logs
+from data_minimization_tools.cvdi.cache import CvdiResultCache
+from data_minimization_tools.cvdi.results import CvdiSetupException, PermanentCvdiException, RetryableCvdiException
+from data_minimization_tools.vault import PseudonymVault
+from data_minimization_tools.worker import build_pipeline, run_pipeline, numeric_keys, read_records, write_records
+from data_minimization_tools.worker.stream import run_topology, IterableSource, ListSink
 
 
 @ddt
@@ -66,6 +87,214 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(drop_keys(test_data, ["A", "C.A", "C[].A", "C.C.A"]), expected)
         self.assertEqual(drop_keys(test_data, ["X", "X.X", "C.X", "A[]", "A[].", "A[].X", "X[].X"]), test_data)
 
+    def test_add_noise(self):
+        def make_data():
+            return [{"A": 5, "B": {"C": [{"D": 100}, {"D": None}]}} for _ in range(1000)]
+
+        result = add_noise(make_data(), ["A", "B.C[].D"], scale={"A": 1, "B.C[].D": 0.1}, seed=42)
+        self.assertEqual(result, add_noise(make_data(), ["A", "B.C[].D"], scale={"A": 1, "B.C[].D": 0.1}, seed=42))
+        self.assertNotEqual(result, add_noise(make_data(), ["A", "B.C[].D"], seed=43))
+        self.assertAlmostEqual(statistics.mean(item["A"] for item in result), 5, delta=0.2)
+        self.assertTrue(all(abs(item["B"]["C"][0]["D"] - 100) < 2 for item in result))
+        self.assertTrue(all(item["B"]["C"][1]["D"] is None for item in result))
+
+        two_keys = [{"A": 5, "B": 5}]
+        self.assertNotEqual(add_noise([dict(item) for item in two_keys], "A", seed=42)[0]["A"],
+                            add_noise([dict(item) for item in two_keys], "B", seed=42)[0]["B"])
+        self.assertEqual(add_noise([dict(item) for item in two_keys], ["A", "B"], seed=42),
+                         add_noise([dict(item) for item in two_keys], ["B", "A"], seed=42))
+
+        seed = SeedSequence(42)
+        self.assertEqual(add_noise(make_data(), "A", seed=seed), add_noise(make_data(), "A", seed=seed))
+
+        worker_config = {"tasks": [{"name": "add_noise-1", "input_topic": "in", "output_topic": "out",
+                                    "function": {"signature": "add_noise", "args": {"keys": ["A"], "seed": 42}}}]}
+        batches = list(run_pipeline(make_data()[:2], build_pipeline(worker_config), batch_size=1))
+        self.assertNotEqual(batches[0][0]["A"], batches[1][0]["A"])
+        self.assertEqual(batches, list(run_pipeline(make_data()[:2], build_pipeline(worker_config), batch_size=1)))
+
+    def test_tokenize_keys(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            vault_path = os.path.join(tmp_dir, "vault.db")
+            result = tokenize_keys([{"A": 5, "B": "x"}, {"A": 5, "B": "y"}, {"A": 6, "B": "x"}, {"B": None}], ["A", "B"],
+                                   vault_path)
+            self.assertEqual(result[3], {"B": None})
+            self.assertEqual(result[0]["A"], result[1]["A"])
+            self.assertNotEqual(result[0]["A"], result[2]["A"])
+            self.assertEqual(result[0]["B"], result[2]["B"])
+
+            with PseudonymVault(vault_path, cache_size=0) as vault:
+                self.assertEqual(vault.tokenize(5), result[0]["A"])
+                self.assertEqual(vault.tokenize("y"), result[1]["B"])
+
+            with ThreadPoolExecutor(1) as executor:
+                other_thread_result = executor.submit(tokenize_keys, [{"A": 5}], "A", vault_path).result()
+            self.assertEqual(other_thread_result, [{"A": result[0]["A"]}])
+
+    def test_worker_pipeline(self):
+        worker_config = {"tasks": [
+            {"name": "drop_keys-2", "input_topic": "between", "output_topic": "out",
+             "function": {"signature": "drop_keys", "args": {"keys": ["A"]}}},
+            {"name": "reduce_to_nearest_value-1", "input_topic": "in", "output_topic": "between",
+             "function": {"signature": "reduce_to_nearest_value", "args": {"keys": ["B"], "step_width": 3}}}
+        ]}
+        records = [{"A": 5, "B": 4}, {"A": 5, "B": -11}, {"A": 5, "B": 0}]
+        batches = list(run_pipeline(records, build_pipeline(worker_config), batch_size=2))
+        self.assertEqual(batches, [[{"A": None, "B": 3}, {"A": None, "B": -12}], [{"A": None, "B": 0}]])
+
+        records = list(read_records(io.StringIO("A,B,C\n01234,4,nan\n,-11,\n"), "csv", numeric_keys(worker_config)))
+        self.assertEqual(records, [{"A": "01234", "B": 4, "C": "nan"}, {"A": "", "B": -11, "C": ""}])
+
+        output = io.StringIO()
+        write_records(output, [[{"A": 1}, {"B": 2}], [{"A": 3, "B": 4}]], "csv")
+        self.assertEqual(output.getvalue(), "A,B\r\n1,\r\n,2\r\n3,4\r\n")
+        self.assertRaises(ValueError, write_records, io.StringIO(), [[{"A": 1}], [{"A": 3, "B": 4}]], "csv")
+
+        records = [{"A": 5, "B": 4}, {"A": 5, "B": -11}, {"A": 5, "B": 0}]
+        sink = ListSink()
+        asyncio.run(run_topology(worker_config, IterableSource(records, batch_size=1), sink, batch_size=2,
+                                 flush_interval=0.01))
+        self.assertEqual(sink.records, [{"A": None, "B": 3}, {"A": None, "B": -12}, {"A": None, "B": 0}])
+
+        # both tasks read the same topic, neither may see the other's changes
+        fan_out_config = {"tasks": [dict(task, input_topic="in", output_topic=task["name"])
+                                    for task in worker_config["tasks"]]}
+        sink = ListSink()
+        asyncio.run(run_topology(fan_out_config, IterableSource([{"A": 5, "B": 4}]), sink, flush_interval=0.01))
+        self.assertCountEqual(sink.records, [{"A": None, "B": 4}, {"A": 5, "B": 3}])
+
+    @unpack
+    @data({
+        "test_data": [
+            {"A": 5, "B": 4},
+            {"A": 5, "B": 4, "C": {"A": "foo", "B": 4, "C": {"A": [1, 2, 3], "B": 4}}},
+            {"A": 5, "B": 4, "C": [{"A": "foo", "B": 4}, {"A": [1, 2, 3], "B": 4}]}
+        ],
+        "expected_keep": [
+            {"A": 5},
+            {"A": 5, "C": {"A": "foo", "C": {"A": [1, 2, 3]}}},
+            {"A": 5, "C": [{"A": "foo"}, {"A": [1, 2, 3]}]}
+        ],
+        "expected_drop": [
+            {"B": 4},
+            {"B": 4, "C": {"B": 4, "C": {"B": 4}}},
+            {"B": 4, "C": [{"B": 4}, {"B": 4}]}
+        ]})
+    def test_project_keys(self, test_data, expected_keep, expected_drop):
+        keys = ["A", "C.A", "C[].A", "C.C.A", "X", "X.X", "A[].X"]
+        self.assertEqual(project_keys(test_data, keep=keys), expected_keep)
+        self.assertEqual(project_keys(test_data, drop=keys), expected_drop)
+
+    @unpack
+    @data({
+        "test_data": [
+            {"A": 1600000123, "B": "2020-09-13T12:28:43", "C": datetime.datetime(2020, 9, 13, 12, 28, 43), "D": None},
+            {"A": 1600003723, "B": "2020-09-13T13:28:43", "C": datetime.datetime(2020, 9, 13, 13, 28, 43), "D": None}
+        ],
+        "expected": [
+            {"A": 1599998400, "B": "2020-09-13T12:00:00", "C": datetime.datetime(2020, 9, 13, 12), "D": None},
+            {"A": 1600002000, "B": "2020-09-13T13:00:00", "C": datetime.datetime(2020, 9, 13, 13), "D": None}
+        ]})
+    def test_timestamps(self, test_data, expected):
+        shifted = shift_timestamps([dict(item) for item in test_data], ["A", "B", "C", "D"], max_shift=600, seed=1)
+        offsets = {item["A"] - original["A"] for item, original in zip(shifted, test_data)}
+        self.assertEqual(len(offsets), 1)
+        self.assertLessEqual(abs(offsets.pop()), 600)
+        self.assertEqual(shifted[0]["C"] - test_data[0]["C"], datetime.timedelta(seconds=shifted[0]["A"] - test_data[0]["A"]))
+
+        self.assertEqual(generalize_timestamps([dict(item) for item in test_data], ["A", "B", "C", "D"], "weekday"),
+                         [{"A": 6, "B": 6, "C": 6, "D": None}] * 2)
+        self.assertEqual(generalize_timestamps(test_data, ["A", "B", "C", "D"], "h"), expected)
+
+        self.assertEqual(generalize_timestamps([{"B": "2020-09-13T12:28:43.125+05:30"}, {"B": "2020-09-13 12:28:43Z"}],
+                                               "B", "min"),
+                         [{"B": "2020-09-13T12:28:00.000+05:30"}, {"B": "2020-09-13T12:28:00Z"}])
+        self.assertEqual(generalize_timestamps([{"B": "2020-09-13T10:28:43-05"}], "B", "h"),
+                         [{"B": "2020-09-13T10:00:00-05"}])
+
+        # dates alone cannot be shifted by seconds, times without seconds gain them
+        self.assertRaises(ValueError, shift_timestamps, [{"B": "2020-09-13"}], "B", seed=1)
+        shifted = shift_timestamps([{"B": "2020-09-13T10:28-05"}], "B", max_shift=600, seed=1)[0]["B"]
+        self.assertRegex(shifted, r"^2020-09-13T10:\d{2}:\d{2}-05$")
+        self.assertNotEqual(shifted, "2020-09-13T10:28:00-05")
+
+    def test_shift_timestamps_per_journey(self):
+        def make_batch(*journeys):
+            return [{"journey": journey, "time": 1600000000} for journey in journeys]
+
+        first_batch = shift_timestamps(make_batch("x", "y"), "time", journey_key="journey", seed=7)
+        second_batch = shift_timestamps(make_batch("z", "y", "y"), "time", journey_key="journey", seed=7)
+        self.assertEqual(first_batch[1], second_batch[1])
+        self.assertEqual(second_batch[1], second_batch[2])
+        self.assertNotEqual(first_batch[0]["time"], first_batch[1]["time"])
+        self.assertEqual(shift_timestamps(make_batch("y"), "time", journey_key="journey", seed=SeedSequence(7)),
+                         [first_batch[1]])
+
+    def test_kanon_cache(self):
+        sample = pd.read_csv(os.path.join(get_script_directory(), "data/example-activity.csv"))
+        cn_config = {
+            "start_latitude": ("quasi", _Hierarchy("interval", 1, 2, 4)),
+            "external_id": ("identifying", None)
+        }
+        generalization = {"start_latitude": "[51.0, 57.0)", "external_id": "*"}
+
+        self.assertEqual(generate_config._fingerprint_cn_config(cn_config),
+                         generate_config._fingerprint_cn_config({
+                             "external_id": ("identifying", None),
+                             "start_latitude": ("quasi", _Hierarchy("interval", 1, 2, 4))}))
+        self.assertNotEqual(generate_config._fingerprint_cn_config(cn_config),
+                            generate_config._fingerprint_cn_config({
+                                **cn_config, "start_latitude": ("quasi", _Hierarchy("interval", 1, 2, 8))}))
+        self.assertIsNone(generate_config._fingerprint_cn_config({"A": ("quasi", object())}))
+        self.assertNotEqual(generate_config._fingerprint_sample(sample),
+                            generate_config._fingerprint_sample(sample.iloc[1:]))
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(generate_config, "_protect", return_value=generalization) as protect, \
+                mock.patch.object(generate_config, "MAX_CACHE_ENTRIES", 3):
+            self.assertEqual(generate_config._protect_cached(sample, 2, cn_config, tmp_dir, False), generalization)
+            self.assertEqual(generate_config._protect_cached(sample, 2, cn_config, tmp_dir, False), generalization)
+            self.assertEqual(protect.call_count, 1)
+
+            generate_config._protect_cached(sample, 3, cn_config, tmp_dir, False)
+            generate_config._protect_cached(sample.iloc[1:], 2, cn_config, tmp_dir, False)
+            self.assertEqual(protect.call_count, 3)
+            self.assertLessEqual(len(os.listdir(tmp_dir)), 3)
+
+            generate_config._protect_cached(sample, 2, {"A": ("quasi", object())}, tmp_dir, False)
+            generate_config._protect_cached(sample, 2, {"A": ("quasi", object())}, tmp_dir, False)
+            self.assertEqual(protect.call_count, 5)
+
+    def test_kanon_incremental(self):
+        sample = pd.DataFrame({"start_latitude": [1.0, 2.0, 3.0], "external_id": ["a", "b", "c"]})
+        cn_config = {
+            "start_latitude": ("quasi", _Hierarchy("interval", 1, 2, 4)),
+            "external_id": ("identifying", None)
+        }
+        generalization = {"start_latitude": "[0.0, 4.0)", "external_id": "*"}
+        hierarchy_module = type(sys)("cn.protect.hierarchy")
+        hierarchy_module.OrderHierarchy = _Hierarchy
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.dict(sys.modules, {"cn": type(sys)("cn"), "cn.protect": type(sys)("cn.protect"),
+                                              "cn.protect.hierarchy": hierarchy_module}), \
+                mock.patch.object(generate_config, "_protect", return_value=generalization) as protect:
+            generate_config._protect_cached(sample, 2, cn_config, tmp_dir, True)
+            self.assertEqual(protect.call_count, 1)
+
+            # still k-anonymous with the previous generalization
+            grown = pd.concat([sample, pd.DataFrame({"start_latitude": [3.5], "external_id": ["d"]})])
+            self.assertEqual(generate_config._protect_cached(grown, 2, cn_config, tmp_dir, True), generalization)
+            self.assertEqual(protect.call_count, 1)
+
+            # 5.0 is alone in [4.0, 8.0)
+            grown = pd.concat([grown, pd.DataFrame({"start_latitude": [5.0], "external_id": ["e"]})])
+            generate_config._protect_cached(grown, 2, cn_config, tmp_dir, True)
+            self.assertEqual(protect.call_count, 2)
+
+            self.assertEqual(generate_config._protect_cached(grown, 2, cn_config, None, True), generalization)
+            self.assertEqual(protect.call_count, 3)
+
     # @file_data("data/kanon.yml")
     # def test_kanon(self, expected: dict):
     #     sample = pd.read_csv(os.path.join(get_script_directory(), "data/example-activity.csv"))
@@ -82,6 +311,127 @@ class MyTestCase(unittest.TestCase):
     #         del a_function["name"], e_function["name"]
     #     self.assertEqual(actual, {"tasks": expected})
 
+    def test_segment_journey(self):
+        key_mapping = {"lat": "Latitude", "lng": "Longitude", "heading": "Heading", "speed": "Speed", "time": "Gentime"}
+        # moving, stopped for 100s, moving, gap of 700s, moving. Another device in between.
+        data = [{"lat": 1, "lng": 2, "heading": 0, "speed": 1 if 100 <= time < 200 else 10, "time": time, "dev": "a"}
+                for time in chain(range(300), range(1000, 1010))]
+        data += [{"lat": 1, "lng": 2, "heading": 0, "speed": 10, "time": time, "dev": "b"} for time in range(50, 60)]
+
+        trips = segment_journey(data, key_mapping, device_key="dev", gentime_unit=1)
+        self.assertEqual([(trip[0]["time"], trip[-1]["time"], trip[0]["dev"]) for trip in trips],
+                         [(0, 99, "a"), (200, 299, "a"), (1000, 1009, "a"), (50, 59, "b")])
+        self.assertTrue(all(len({point["dev"] for point in trip}) == 1 for trip in trips))
+
+    def test_cvdi_result_cache(self):
+        input_path = os.path.join(get_script_directory(), "data/cvdi/csv/strict.in.csv")
+        result_path = os.path.join(get_script_directory(), "data/cvdi/csv/strict.di.csv")
+        config_path = os.path.join(get_script_directory(), "data/cvdi/direct.yml")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = CvdiResultCache(tmp_dir, max_bytes=os.path.getsize(result_path) + 1)
+            key = cache.key_for(input_path, config_path, result_path)
+            other_key = cache.key_for(input_path, result_path, result_path)
+            self.assertNotEqual(key, other_key)
+            self.assertIsNone(cache.get(key))
+
+            cache.put(key, result_path)
+            with open(cache.get(key)) as cached, open(result_path) as original:
+                self.assertEqual(cached.read(), original.read())
+
+            # only one result fits, the least recently used one is evicted
+            cache.put(other_key, result_path)
+            self.assertIsNone(cache.get(key))
+            self.assertIsNotNone(cache.get(other_key))
+
+            def stored_results():
+                return sorted(name for name in os.listdir(tmp_dir) if name.endswith(".csv"))
+
+            # results stored at the same time from several threads are all written, and known to a new instance
+            keys = [str(number) * 64 for number in range(4)]
+            with ThreadPoolExecutor(4) as executor:
+                list(executor.map(lambda key: cache.put(key, result_path), keys * 2))
+            self.assertIn(stored_results(), [[f"{key}.csv"] for key in keys])
+            cache = CvdiResultCache(tmp_dir, max_bytes=0)
+            cache.put(other_key, result_path)
+            self.assertEqual(stored_results(), [])
+
+            # the bound holds for the directory, not per instance
+            caches = [CvdiResultCache(tmp_dir, max_bytes=2 * os.path.getsize(result_path)) for _ in range(2)]
+            for number, key in enumerate(keys):
+                caches[number % 2].put(key, result_path)
+            self.assertEqual(stored_results(), [f"{key}.csv" for key in keys[2:]])
+            self.assertIsNone(caches[0].get(keys[0]))
+            self.assertIsNotNone(caches[0].get(keys[3]))
+
+    def test_cvdi_kml_location_and_failed_caching(self):
+        input_path = os.path.join(get_script_directory(), "data/cvdi/csv/strict.in.csv")
+        result_path = os.path.join(get_script_directory(), "data/cvdi/csv/strict.di.csv")
+        with open(input_path) as in_file:
+            data = [{key: float(val) if val != "" else None for key, val in r.items()} for r in csv.DictReader(in_file)]
+        key_mapping = {key: key for key in ["Latitude", "Longitude", "Heading", "Speed", "Gentime"]}
+
+        def run_cvdi(executable_path, config_dir, out_dir, quad_file_path=None):
+            shutil.copy(result_path, out_dir)
+            with open(os.path.join(out_dir, "trip.kml"), "w") as kml_file:
+                kml_file.write("<kml/>")
+            return subprocess.CompletedProcess([], 0, b"", b"total,invalid_fields,invalid_GPS,invalid_heading,error,"
+                                                           b"critical_interval,privacy_interval\n617,0,0,0,2,40,28\n")
+
+        working_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch("data_minimization_tools.cvdi.run_cvdi", side_effect=run_cvdi):
+            os.chdir(tmp_dir)
+            try:
+                anonymize_journey(data, key_mapping, {"plot_kml": 1})
+                self.assertEqual(os.listdir(os.path.join(tmp_dir, "cvdi-consume")), ["trip.kml"])
+
+                # a result that cannot be cached does not fail the run
+                open(os.path.join(tmp_dir, "cvdi-conf", "quad"), "w").close()
+                cache = CvdiResultCache(os.path.join(tmp_dir, "cache"))
+                with mock.patch.object(cache, "put", side_effect=OSError("No space left on device")), \
+                        self.assertWarns(RuntimeWarning):
+                    self.assertTrue(anonymize_journey(data, key_mapping, cache=cache))
+            finally:
+                os.chdir(working_directory)
+
+    @unpack
+    @data({"summary": b"total,invalid_fields,invalid_GPS,invalid_heading,error,critical_interval,privacy_interval\n"
+                      b"617,0,0,0,2,40,28\n", "expected": (617, 0, 0, 0, 2, 40, 28, None, 1.5)},
+          {"summary": b"total,invalid_fields,invalid_GPS,invalid_heading,error,critical_interval,privacy_interval\n"
+                      b"12,0,0,0,0,0,0\n", "expected": PermanentCvdiException},
+          {"summary": b"Could not open shape file: cvdi-conf/quad\n", "expected": CvdiSetupException},
+          {"summary": b"", "expected": RetryableCvdiException})
+    def test_cvdi_process_logs(self, summary, expected):
+        process = subprocess.CompletedProcess([], 0, b"", b"*** Configuration ***\nPlot KML: 0\n" + summary)
+        if isinstance(expected, tuple):
+            self.assertEqual(tuple(check_process_logs(process, 1.5)), expected)
+        else:
+            self.assertRaises(expected, check_process_logs, process, 1.5)
+
+    def test_cvdi_missing_quad_file(self):
+        input_path = os.path.join(get_script_directory(), "data/cvdi/csv/strict.in.csv")
+        with open(input_path) as in_file:
+            data = [{key: float(val) if val != "" else None for key, val in r.items()} for r in csv.DictReader(in_file)]
+        key_mapping = {key: key for key in ["Latitude", "Longitude", "Heading", "Speed", "Gentime"]}
+        process = subprocess.CompletedProcess([], 0, b"", b"Could not open shape file: cvdi-conf/quad\n")
+
+        working_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch("data_minimization_tools.cvdi.run_cvdi", return_value=process) as run_cvdi:
+            os.chdir(tmp_dir)
+            try:
+                self.assertRaises(CvdiSetupException, cvdi.anonymize_journeys, data, key_mapping)
+            finally:
+                os.chdir(working_directory)
+        self.assertTrue(run_cvdi.called)
+
+    def test_cvdi_failures(self):
+        key_mapping = {key: key for key in ["Latitude", "Longitude", "Heading", "Speed", "Gentime"]}
+        self.assertRaises(PermanentCvdiException, cvdi._revert_dict_preparation_for_cvdi_consumption,
+                          [{"Gentime": 2.0, "Latitude": 1.0}], [{"Gentime": 1.0, "Latitude": 2.0}], key_mapping)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.assertRaises(CvdiSetupException, cvdi.run_cvdi, os.path.join(tmp_dir, "cv_di"), tmp_dir, tmp_dir)
+
     @file_data("data/cvdi/direct.yml")
     def test_cvdi_directly(self, input, config_overrides, expected):
         key_mapping = {
@@ -108,6 +458,11 @@ class MyTestCase(unittest.TestCase):
         self.assertAlmostEqual(result, expected)
 
 
+class _Hierarchy:
+    def __init__(self, *args):
+        self.args = args
+
+
 def _preprocess_fitfile(file_path):
     ff = FitFile(file_path)
     data = []